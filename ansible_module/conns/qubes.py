@@ -34,6 +34,94 @@ DOCUMENTATION = """
         default: user
         vars:
             - name: ansible_user
+      max_sessions:
+        description:
+            - Maximum number of qrexec sessions running at the same time from
+              all the ansible workers. The other ones wait in a queue. 0 disables the limit.
+        default: 16
+        type: int
+        vars:
+            - name: ansible_qubes_max_sessions
+        env:
+            - name: ANSIBLE_QUBES_MAX_SESSIONS
+        ini:
+            - section: qubes_connection
+              key: max_sessions
+      max_sessions_per_vm:
+        description:
+            - Maximum number of qrexec sessions running at the same time to a
+              single vm. 0 disables the limit.
+        default: 0
+        type: int
+        vars:
+            - name: ansible_qubes_max_sessions_per_vm
+        env:
+            - name: ANSIBLE_QUBES_MAX_SESSIONS_PER_VM
+        ini:
+            - section: qubes_connection
+              key: max_sessions_per_vm
+      fetch_channels:
+        description:
+            - Number of qrexec sessions used in parallel to fetch a large file.
+        default: 4
+        type: int
+        vars:
+            - name: ansible_qubes_fetch_channels
+        env:
+            - name: ANSIBLE_QUBES_FETCH_CHANNELS
+        ini:
+            - section: qubes_connection
+              key: fetch_channels
+      fetch_chunk_size:
+        description:
+            - Size in bytes of the parts of a file fetched in parallel. Smaller
+              files are fetched in one qrexec session.
+        default: 67108864
+        type: int
+        vars:
+            - name: ansible_qubes_fetch_chunk_size
+        env:
+            - name: ANSIBLE_QUBES_FETCH_CHUNK_SIZE
+        ini:
+            - section: qubes_connection
+              key: fetch_chunk_size
+      fetch_verify:
+        description:
+            - Compare the sha256 checksum of a fetched file with the one of the file in the vm.
+        default: true
+        type: bool
+        vars:
+            - name: ansible_qubes_fetch_verify
+        env:
+            - name: ANSIBLE_QUBES_FETCH_VERIFY
+        ini:
+            - section: qubes_connection
+              key: fetch_verify
+      native_become:
+        description:
+            - Run the tasks using become to root with the qubes.VMRootShell
+              service (or as root with qubes.VMShell if the vm does not have
+              it), instead of wrapping them in sudo or su.
+        default: true
+        type: bool
+        vars:
+            - name: ansible_qubes_native_become
+        env:
+            - name: ANSIBLE_QUBES_NATIVE_BECOME
+        ini:
+            - section: qubes_connection
+              key: native_become
+      lock_dir:
+        description:
+            - Directory for the lock files used to limit the qrexec sessions,
+              by default a per user directory under XDG_RUNTIME_DIR or the temporary directory.
+        vars:
+            - name: ansible_qubes_lock_dir
+        env:
+            - name: ANSIBLE_QUBES_LOCK_DIR
+        ini:
+            - section: qubes_connection
+              key: lock_dir
 #        keyword:
 #            - name: hosts
 """
@@ -43,13 +131,24 @@ import shutil
 
 import os
 import base64
+import fcntl
+import hashlib
+import stat
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import ansible.constants as C
 from ansible.module_utils._text import to_bytes, to_native
 from ansible.plugins.connection import ConnectionBase, ensure_connect
 
 
+# Size of the reads while copying fetched data
+BUFSIZE = 1024 * 1024
+
+
 try:
     from __main__ import display
 except ImportError:
@@ -57,6 +156,82 @@ except ImportError:
     display = Display()
 
 
+def sha256_file(path):
+    """Returns the sha256 hex digest of the local file"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fobj:
+        for data in iter(lambda: fobj.read(BUFSIZE), b""):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+class QrexecLimiter(object):
+    """Limits the number of concurrent qrexec sessions from all the ansible workers.
+
+    Every session holds a slot, which is a flock on one of the slot files in the
+    lock directory. The waiting sessions line up on the flock of a queue file,
+    and only the one holding it polls for a free slot. flock does not promise
+    any order between the waiters, so this is not strictly first come first
+    served, but no waiter can keep grabbing the slots ahead of the others.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, lock_dir, max_sessions, max_sessions_per_vm):
+        self.lock_dir = lock_dir
+        self.max_sessions = max_sessions
+        self.max_sessions_per_vm = max_sessions_per_vm
+        # Many workers may get here at the same time on the first run
+        os.makedirs(lock_dir, 0o700, exist_ok=True)
+        # The default directory may be in /tmp, so make sure nobody else
+        # could have prepared it for us
+        st = os.lstat(lock_dir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+            raise RuntimeError('The qubes lock directory {0} must be a directory owned by the '
+                               'current user with mode 0700'.format(lock_dir))
+
+    def _open(self, name):
+        return os.open(os.path.join(self.lock_dir, name), os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _acquire(self, prefix, count):
+        "Waits for one of the count slots, returns the fd holding it"
+        queue_fd = self._open(prefix + ".queue")
+        try:
+            fcntl.flock(queue_fd, fcntl.LOCK_EX)
+            while True:
+                for i in range(count):
+                    fd = self._open("%s.%d" % (prefix, i))
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        return fd
+                    except (IOError, OSError):
+                        os.close(fd)
+                time.sleep(self.poll_interval)
+        finally:
+            # Closing the fd releases the lock, the next in the queue can go
+            os.close(queue_fd)
+
+    @contextmanager
+    def session(self, vmname):
+        """Holds a slot for one qrexec session to vmname.
+
+        The per vm slot is always taken before the global one, so that no two
+        sessions wait on each other.
+        """
+        start = time.time()
+        held = []
+        try:
+            if self.max_sessions_per_vm > 0:
+                held.append(self._acquire("vm-%s" % vmname, self.max_sessions_per_vm))
+            if self.max_sessions > 0:
+                held.append(self._acquire("global", self.max_sessions))
+            display.vvv("QREXEC queue wait %.3fs" % (time.time() - start), host=vmname)
+            yield
+        finally:
+            for fd in held:
+                os.close(fd)
+
+
 # this _has to be_ named Connection
 class Connection(ConnectionBase):
     """This is a connection plugin for qubes: it uses qubes-run-vm binary to interact with the containers."""
@@ -74,24 +249,100 @@ class Connection(ConnectionBase):
         self.user = "user"
         if self._play_context.remote_user:
             self.user = self._play_context.remote_user
-
-    def _qubes(self, cmd=None, in_data=None, shell="qubes.VMShell"):
+        self._limiter = None
+
+    @property
+    def become(self):
+        """The become plugin, None when become is done natively by the connection"""
+        if self._native_become():
+            return None
+        return self._become_plugin
+
+    @become.setter
+    def become(self, plugin):
+        self._become_plugin = plugin
+
+    def _native_become(self):
+        """Tells if the become to root can be done with a root qrexec service"""
+        plugin = self._become_plugin
+        if plugin is None or getattr(plugin, 'name', None) not in ('sudo', 'su'):
+            return False
+        if self._play_context.become_user not in (None, '', 'root'):
+            return False
+        return self.get_option('native_become')
+
+    def _lock_dir(self):
+        lock_dir = self.get_option('lock_dir')
+        if not lock_dir:
+            base_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+            lock_dir = os.path.join(base_dir, "qubes-ansible-%d" % os.getuid())
+        return lock_dir
+
+    def _qrexec_session(self):
+        """Returns the context manager holding a qrexec session slot for the vm"""
+        if self._limiter is None:
+            self._limiter = QrexecLimiter(self._lock_dir(), self.get_option('max_sessions'),
+                                          self.get_option('max_sessions_per_vm'))
+        return self._limiter.session(self._remote_vmname)
+
+    def _has_root_shell(self):
+        """Tells if the vm has the qubes.VMRootShell service.
+
+        The answer is cached in the lock directory, so that all the ansible
+        workers only check it once per vm. Only a definite answer is cached,
+        any other failure (like a vm still starting) is checked again next time.
+        """
+        cache_path = os.path.join(self._lock_dir(), "rootshell-%s" % self._remote_vmname)
+        if os.path.exists(cache_path):
+            with open(cache_path) as fobj:
+                return fobj.read() == "1"
+        retcode, dummy, dummy = self._qubes("true", shell="qubes.VMRootShell")
+        if retcode == 0:
+            supported = True
+        elif retcode == 127:
+            supported = False
+        else:
+            return False
+        # Written aside and renamed, so the other workers never read half of it
+        fd, tmp_path = tempfile.mkstemp(dir=self._lock_dir())
+        with os.fdopen(fd, "w") as fobj:
+            fobj.write("1" if supported else "0")
+        os.replace(tmp_path, cache_path)
+        return supported
+
+    def _qubes(self, cmd=None, in_data=None, shell="qubes.VMShell", user=None):
         """run qvm-run executable
 
         :param cmd: cmd string for remote system
         :param in_data: data passed to qvm-run-vm's stdin
+        :param user: user to run the service as, by default the remote_user
         :return: return code, stdout, stderr
         """
         display.vvvv("CMD: ", cmd)
         if not cmd.endswith("\n"):
             cmd = cmd + "\n"
+        local_cmd = self._local_cmd(shell, user)
+
+        display.vvv("RUN %s" % (local_cmd,), host=self._remote_vmname)
+        with self._qrexec_session():
+            p = subprocess.Popen(local_cmd, shell=False, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+            # Here we are writing the actual command to the remote bash
+            p.stdin.write(to_bytes(cmd, errors='surrogate_or_strict'))
+            stdout, stderr = p.communicate(input=in_data)
+        return p.returncode, stdout, stderr
+
+    def _local_cmd(self, shell, user=None):
+        """Returns the qvm-run command line calling the given service in the vm"""
         local_cmd = []
+        user = user or self.user
 
         # For dom0
         local_cmd.extend(["qvm-run", "--pass-io", "--service"])
-        if self.user != "user":
+        if user != "user":
             # Means we have a remote_user value
-            local_cmd.extend(["-u", self.user])
+            local_cmd.extend(["-u", user])
 
         local_cmd.append(self._remote_vmname)
 
@@ -100,15 +351,7 @@ class Connection(ConnectionBase):
         local_cmd = [to_bytes(i, errors='surrogate_or_strict') for i in local_cmd]
 
         display.vvvv("Local cmd: ", local_cmd)
-
-        display.vvv("RUN %s" % (local_cmd,), host=self._remote_vmname)
-        p = subprocess.Popen(local_cmd, shell=False, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        # Here we are writing the actual command to the remote bash
-        p.stdin.write(to_bytes(cmd, errors='surrogate_or_strict'))
-        stdout, stderr = p.communicate(input=in_data)
-        return p.returncode, stdout, stderr
+        return local_cmd
 
     def _connect(self):
         """No persistent connection is being maintained."""
@@ -122,7 +365,14 @@ class Connection(ConnectionBase):
 
         display.vvvv("CMD IS: %s" % cmd)
 
-        rc, stdout, stderr = self._qubes(cmd)
+        if sudoable and self._native_become():
+            # No sudo in between, the service itself runs as root
+            if self._has_root_shell():
+                rc, stdout, stderr = self._qubes(cmd, shell="qubes.VMRootShell")
+            else:
+                rc, stdout, stderr = self._qubes(cmd, user="root")
+        else:
+            rc, stdout, stderr = self._qubes(cmd)
 
         display.vvvvv("STDOUT %r STDERR %r" % (stderr, stderr))
         return rc, stdout, stderr
@@ -144,18 +394,99 @@ class Connection(ConnectionBase):
         if retcode != 0:
             raise RuntimeError('Failed to put_file to {0}'.format(out_path))
 
+    def _remote_sha256(self, in_path, length=None):
+        """Returns the sha256 of the file in the vm (of its first length bytes), None if it can not be found"""
+        quoted = shlex.quote(in_path)
+        if length is None:
+            cmd = "sha256sum < {0}".format(quoted)
+        else:
+            cmd = "head -c {0} {1} | sha256sum".format(length, quoted)
+        retcode, stdout, dummy = self._qubes(cmd)
+        if retcode != 0:
+            return None
+        return to_native(stdout).split()[0]
+
+    def _fetch_range(self, in_path, out_path, offset, length):
+        """Copies length bytes from offset of the file in the vm into out_path at the same offset"""
+        cmd = "dd if={0} bs=1M iflag=skip_bytes,count_bytes skip={1} count={2} status=none\n".format(
+            shlex.quote(in_path), offset, length)
+        copied = 0
+        with open(out_path, "r+b") as fobj, self._qrexec_session():
+            fobj.seek(offset)
+            p = subprocess.Popen(self._local_cmd("qubes.VMShell"), shell=False, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            p.stdin.write(to_bytes(cmd, errors='surrogate_or_strict'))
+            p.stdin.close()
+            while True:
+                data = p.stdout.read(BUFSIZE)
+                if not data:
+                    break
+                fobj.write(data)
+                copied += len(data)
+            p.wait()
+        if p.returncode != 0 or copied != length:
+            raise RuntimeError('Failed to fetch file to {0}'.format(out_path))
+
+    def _fetch_ranges(self, in_path, out_path, offset, size):
+        """Fetches the file from offset till size, the large files in parallel chunks.
+
+        If a chunk fails, out_path is truncated to the data fetched without any
+        gaps, so that the next fetch can resume from there.
+        """
+        chunk_size = max(1, self.get_option('fetch_chunk_size'))
+        ranges = []
+        while offset < size:
+            length = min(chunk_size, size - offset)
+            ranges.append((offset, length))
+            offset += length
+        if len(ranges) <= 1 or self.get_option('fetch_channels') <= 1:
+            ranges = [(ranges[0][0], size - ranges[0][0])] if ranges else []
+        with ThreadPoolExecutor(max_workers=max(1, self.get_option('fetch_channels'))) as executor:
+            futures = [executor.submit(self._fetch_range, in_path, out_path, start, length)
+                       for start, length in ranges]
+        for (start, dummy), future in zip(ranges, futures):
+            if future.exception() is not None:
+                with open(out_path, "r+b") as fobj:
+                    fobj.truncate(start)
+                raise future.exception()
+
     def fetch_file(self, in_path, out_path):
-        """Obtain file specified via 'in_path' from the container and place it at 'out_path' """
+        """Obtain file specified via 'in_path' from the container and place it at 'out_path'
+
+        A partial 'out_path' from an earlier fetch is resumed if it matches the
+        start of the file in the vm.
+        """
         super(Connection, self).fetch_file(in_path, out_path)
         display.vvv("FETCH %s TO %s" % (in_path, out_path), host=self._remote_vmname)
 
-        # We are running in dom0
-        cmd_args_list = ["qvm-run", "--pass-io", self._remote_vmname, "cat {0}".format(in_path)]
-        with open(out_path, "wb") as fobj:
-            p = subprocess.Popen(cmd_args_list, shell=False, stdout=fobj)
-            p.communicate()
-            if p.returncode != 0:
-                raise RuntimeError('Failed to fetch file to {0}'.format(out_path))
+        retcode, stdout, dummy = self._qubes("stat -L -c %s -- {0}".format(shlex.quote(in_path)))
+        if retcode != 0:
+            raise RuntimeError('Failed to fetch file to {0}'.format(out_path))
+        size = int(stdout.strip())
+
+        offset = 0
+        if os.path.exists(out_path):
+            offset = os.path.getsize(out_path)
+            if offset > size:
+                offset = 0
+            elif offset:
+                if sha256_file(out_path) != self._remote_sha256(in_path, offset):
+                    offset = 0
+            if offset:
+                display.vvv("FETCH resuming from %d" % offset, host=self._remote_vmname)
+        with open(out_path, "ab") as fobj:
+            fobj.truncate(offset)
+
+        self._fetch_ranges(in_path, out_path, offset, size)
+
+        if self.get_option('fetch_verify'):
+            expected = self._remote_sha256(in_path)
+            if expected is None:
+                display.warning("Could not find the checksum of {0} in {1}, the fetched file is not verified".format(
+                    in_path, self._remote_vmname))
+                return
+            if sha256_file(out_path) != expected:
+                raise RuntimeError('Checksum mismatch for the file fetched to {0}'.format(out_path))
 
     def close(self):
         """ Closing the connection """
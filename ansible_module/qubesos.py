@@ -30,16 +30,96 @@ options:
       - Note that there may be some lag for state requests like C(shutdown)
         since these refer only to VM states. After starting a guest, it may not
         be immediately accessible.
-    choices: [ destroyed, paused, running, shutdown ]
+    choices: [ destroyed, paused, running, shutdown, reset ]
   command:
     description:
       - In addition to state management, various non-idempotent commands are available.
-    choices: [ create, define, destroy,  info, list_vms, pause, shutdown, start, status, stop, unpause ]
+    choices: [ backup, create, define, destroy, export_volume, firewall, import_volume, info, list_vms, migrate_template, pause, provision, push, run, shutdown, start, status, stop, unpause, watch ]
   autostart:
     description:
       - start VM at host startup.
     type: bool
     version_added: "2.3"
+  vms:
+    description:
+      - List of VMs to create with the C(provision) command. Every item is a
+        dictionary with the I(name), I(vmtype), I(template), I(label), I(netvm)
+        and I(properties) keys, only I(name) is required.
+  workers:
+    description:
+      - Maximum number of VMs handled at the same time by the bulk commands.
+    default: 4
+  pool:
+    description:
+      - Storage pool for the volumes of the VMs created with the C(provision) command.
+  volumes:
+    description:
+      - Names of the volumes reverted by the C(reset) state. By default all
+        the volumes which are saved on VM shutdown.
+  revision:
+    description:
+      - Volume revision to revert to with the C(reset) state, the latest one by default.
+  volume:
+    description:
+      - Name of the volume used by the C(import_volume) and C(export_volume) commands.
+  path:
+    description:
+      - Local file used by the C(import_volume) and C(export_volume) commands.
+      - Backup destination (a path in I(destination_vm)) for the C(backup) command.
+  destination_vm:
+    description:
+      - The VM receiving the backup, the path is local for dom0.
+    default: dom0
+  passphrase:
+    description:
+      - Passphrase used to encrypt the backup.
+  compression:
+    description:
+      - Compression program used by the backup, the default pigz uses all the CPUs.
+    default: pigz
+  backup_state:
+    description:
+      - File keeping the volume revisions of the VMs at their last backup, for every destination_vm and path.
+    default: ~/.qubes-ansible/backup-state.json
+  incremental:
+    description:
+      - Skip the VMs whose volumes did not change since their last backup.
+    type: bool
+    default: true
+  filters:
+    description:
+      - Selects the VMs used by the commands working on many VMs. The I(names)
+        and I(tags) keys take a list, I(name) (a glob pattern), I(klass),
+        I(state), I(template) and I(netvm) a string. A VM must match all of
+        the given keys, and any one of the given tags.
+  until:
+    description:
+      - Makes the C(watch) command return as soon as all the selected VMs are
+        in this state, it fails if that does not happen within I(timeout).
+    choices: [ running, paused, shutdown ]
+  timeout:
+    description:
+      - Number of seconds the C(watch) command listens for events.
+      - Number of seconds the C(run) command waits for the command in each VM.
+      - Number of seconds the C(migrate_template) command waits for each VM to shutdown.
+    default: 60
+  src:
+    description:
+      - Local file copied to the selected VMs by the C(push) command.
+  dest:
+    description:
+      - Path of the file in the VMs for the C(push) command.
+  fields:
+    description:
+      - The values returned for each VM by the C(info) command, by default
+        state, provides_network and label.
+  new_template:
+    description:
+      - The template the C(migrate_template) command moves the VMs to, C(default)
+        for the system default template.
+  cmd:
+    description:
+      - Shell command executed in the selected running VMs by the C(run) command.
   uri:
     description:
       - libvirt connection uri.
@@ -102,12 +182,24 @@ status:
     returned: success
 '''
 
+import asyncio
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import tempfile
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 try:
     import qubesadmin
-    from qubesadmin.exc import QubesVMNotStartedError, QubesTagNotFoundError
+    import qubesadmin.firewall
+    from qubesadmin.events import EventsDispatcher
+    from qubesadmin.exc import QubesVMNotStartedError, QubesTagNotFoundError, QubesException
     from jinja2 import Template
 except ImportError:
     HAS_QUBES = False
@@ -123,11 +215,19 @@ VIRT_SUCCESS = 0
 VIRT_UNAVAILABLE = 2
 
 ALL_COMMANDS = []
-VM_COMMANDS = ['create', 'destroy', 'pause', 'shutdown', 'status', 'start', 'stop', 'unpause', 'removetags']
-HOST_COMMANDS = ['info', 'list_vms', 'get_states', 'createinventory']
+VM_COMMANDS = ['create', 'destroy', 'pause', 'shutdown', 'status', 'start', 'stop', 'unpause', 'removetags',
+               'import_volume', 'export_volume']
+HOST_COMMANDS = ['info', 'list_vms', 'get_states', 'createinventory', 'provision', 'watch', 'backup', 'push', 'run', 'firewall',
+                 'migrate_template']
 ALL_COMMANDS.extend(VM_COMMANDS)
 ALL_COMMANDS.extend(HOST_COMMANDS)
 
+# qubesd reads the backup profiles from here
+BACKUP_PROFILE_DIR = "/etc/qubes/backup"
+
+# Chunk size used while streaming volume data
+CHUNK_SIZE = 1024 * 1024
+
 VIRT_STATE_NAME_MAP = {
     0: 'running',
     1: 'paused',
@@ -136,6 +236,33 @@ VIRT_STATE_NAME_MAP = {
     6: 'crashed',
 }
 
+# The VM state after each of the qubesd events
+EVENT_STATES = {
+    'domain-start': 'running',
+    'domain-start-failed': 'shutdown',
+    'domain-paused': 'paused',
+    'domain-unpaused': 'running',
+    'domain-shutdown': 'shutdown',
+}
+
+FILTERS = {'names': list,
+           'name': str,
+           'klass': str,
+           'state': str,
+           'template': str,
+           'netvm': str,
+           'tags': list,
+          }
+
+# The keys of a firewall rule given as a dictionary
+FIREWALL_RULE_FIELDS = ['action', 'proto', 'dsthost', 'dstports', 'specialtarget',
+                        'icmptype', 'expire', 'comment']
+
+# The values the info command can return for each VM
+INFO_FIELDS = ['state', 'klass', 'tags', 'autostart', 'debug', 'include_in_backups',
+               'kernel', 'label', 'maxmem', 'memory', 'provides_network', 'template',
+               'template_for_dispvms', 'vcpus', 'virt_mode', 'default_dispvm', 'netvm']
+
 PROPS = {'autostart': bool,
          'debug': bool,
          'include_in_backups': bool,
@@ -151,7 +278,8 @@ PROPS = {'autostart': bool,
          'default_dispvm': str,
          'netvm': str,
          'features': dict,
-         'volume': dict,
+         'volume': list,
+         'firewall': list,
         }
 
 
@@ -193,6 +321,45 @@ ansible_connection=qubes
         fobj.write(res)
 
 
+def firewall_rule(rule):
+    "Returns the firewall Rule for a rule given as a string or as a dictionary"
+    if isinstance(rule, dict):
+        return qubesadmin.firewall.Rule(None, **dict((key, str(value)) for key, value in rule.items()))
+    return qubesadmin.firewall.Rule(rule)
+
+
+def copy_sparse(src, dst):
+    "Copies src to dst in chunks, seeking over the zero chunks so that dst stays sparse"
+    zero = bytes(CHUNK_SIZE)
+    total = 0
+    while True:
+        data = src.read(CHUNK_SIZE)
+        if not data:
+            break
+        if data == zero[:len(data)]:
+            dst.seek(len(data), os.SEEK_CUR)
+        else:
+            dst.write(data)
+        total += len(data)
+    # Trailing zero chunks were only skipped
+    dst.truncate(total)
+    return total
+
+
+def run_parallel(func, items, workers):
+    "Calls func for every item using at most workers threads, returns a dict of item: result"
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = dict((executor.submit(func, item), item) for item in items)
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                results[item] = {"failed": True, "msg": to_native(e)}
+    return results
+
+
 class QubesVirt(object):
 
     def __init__(self, module):
@@ -217,12 +384,11 @@ class QubesVirt(object):
             state.append("%s %s" % (vm.name, self.__get_state(vm.name)))
         return state
 
-    def list_vms(self, state):
-        res = []
-        for vm in self.app.domains:
-            if vm.name != "dom0" and state == self.__get_state(vm.name):
-                res.append("%s" % vm.name)
-        return res
+    def list_vms(self, state, filters=None):
+        filters = dict(filters or {})
+        if state:
+            filters["state"] = state
+        return ["%s" % vm.name for vm in self.select_vms(filters)]
 
     def all_vms(self):
         res = {}
@@ -231,16 +397,257 @@ class QubesVirt(object):
                 res.setdefault(vm.klass, []).append(vm.name)
         return res
 
-    def info(self):
-        info = dict()
+    def select_vms(self, filters):
+        "Returns the VMs (except dom0) matching all of the given filters"
+        res = []
         for vm in self.app.domains:
             if vm.name == "dom0":
                 continue
-            info[vm.name] = dict(
-                state=self.__get_state(vm),
-                provides_network=vm.provides_network,
-                label=vm.label.name,
-            )
+            # The name and the class come with the VM list, the other
+            # filters cost an Admin API call each, so those go last
+            if filters.get("names") and vm.name not in filters["names"]:
+                continue
+            if filters.get("name") and not fnmatch.fnmatchcase(vm.name, filters["name"]):
+                continue
+            if filters.get("klass") and vm.klass != filters["klass"]:
+                continue
+            if filters.get("state") and self.__get_state(vm) != filters["state"]:
+                continue
+            if filters.get("template") and \
+                    getattr(getattr(vm, "template", None), "name", None) != filters["template"]:
+                continue
+            if filters.get("netvm") and \
+                    getattr(getattr(vm, "netvm", None), "name", None) != filters["netvm"]:
+                continue
+            # Any one of the tags is enough
+            if filters.get("tags") and not set(filters["tags"]).intersection(vm.tags):
+                continue
+            res.append(vm)
+        return res
+
+    def watch(self, filters, until=None, timeout=60):
+        "Records the state changes of the selected VMs from the qubesd event stream"
+        states = {}
+        events = []
+
+        def condition_met():
+            return until is not None and all(state == until for state in states.values())
+
+        async def listen():
+            connected = asyncio.Event()
+            finished = asyncio.Event()
+            dispatcher = EventsDispatcher(self.app)
+
+            def handler(subject, event, **kwargs):
+                if subject is None or subject.name not in states:
+                    return
+                events.append(dict(
+                    time=time.time(),
+                    name=subject.name,
+                    event=event,
+                    previous=states[subject.name],
+                    state=EVENT_STATES[event],
+                ))
+                states[subject.name] = EVENT_STATES[event]
+                if condition_met():
+                    finished.set()
+
+            dispatcher.add_handler('connection-established', lambda subject, event, **kwargs: connected.set())
+            for event in EVENT_STATES:
+                dispatcher.add_handler(event, handler)
+            deadline = time.time() + timeout
+            listener = asyncio.ensure_future(dispatcher.listen_for_events(reconnect=False))
+            waiter = asyncio.ensure_future(connected.wait())
+            await asyncio.wait([listener, waiter], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not connected.is_set():
+                waiter.cancel()
+                if listener.done():
+                    listener.result()
+                listener.cancel()
+                raise RuntimeError("Could not subscribe to the qubesd events")
+
+            # Subscribed first, so no transition after the snapshot is lost;
+            # the events which came meanwhile are handled after it
+            for vm in self.select_vms(filters):
+                states[vm.name] = self.__get_state(vm)
+            if not states or condition_met():
+                listener.cancel()
+                return
+
+            waiter = asyncio.ensure_future(finished.wait())
+            done, pending = await asyncio.wait([listener, waiter], timeout=max(0, deadline - time.time()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            if listener in done:
+                listener.result()
+                raise RuntimeError("Lost the connection to qubesd")
+
+        asyncio.run(listen())
+        res = {"changed": False, "states": states, "events": events}
+        if until is not None:
+            if not states:
+                res["msg"] = "No VMs matched the filters"
+                return VIRT_FAILED, res
+            res["condition_met"] = condition_met()
+            if not res["condition_met"]:
+                return VIRT_FAILED, res
+        return VIRT_SUCCESS, res
+
+    def volume_revisions(self, vm):
+        "Returns the latest revision of the saved volumes of the VM, None if a volume has no revisions"
+        revisions = {}
+        for name, volume in vm.volumes.items():
+            if not volume.save_on_stop:
+                continue
+            available = volume.revisions
+            if not available:
+                return None
+            revisions[name] = available[-1]
+        return revisions
+
+    def backup(self, filters, destination_vm, path, passphrase, compression="pigz",
+               state_path=None, incremental=True):
+        """ Backs up the selected VMs, skipping the ones not changed since their last backup to the same destination """
+        # Every destination has its own chain of backups
+        key = "%s:%s" % (destination_vm, path)
+        recorded = {}
+        if os.path.exists(state_path):
+            with open(state_path) as fobj:
+                recorded = json.load(fobj).get(key, {})
+
+        current = {}
+        include = []
+        skipped = []
+        for vm in self.select_vms(filters):
+            # The volumes get a new revision every time the VM shuts down
+            current[vm.name] = self.volume_revisions(vm)
+            if incremental and current[vm.name] is not None and recorded.get(vm.name) == current[vm.name]:
+                skipped.append(vm.name)
+            else:
+                include.append(vm.name)
+        if not include:
+            return VIRT_SUCCESS, {"changed": False, "backed_up": [], "skipped": skipped}
+
+        profile_name = "ansible-backup-%d" % os.getpid()
+        profile = dict(
+            include=include,
+            destination_vm=destination_vm,
+            destination_path=path,
+            passphrase_text=passphrase,
+            compression=compression,
+        )
+        profile_path = os.path.join(BACKUP_PROFILE_DIR, profile_name + ".conf")
+        # JSON is valid YAML, only we should be able to read the passphrase
+        with os.fdopen(os.open(profile_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fobj:
+            json.dump(profile, fobj)
+        try:
+            # qubesd streams the backup to the destination itself
+            self.app.qubesd_call("dom0", "admin.backup.Execute", profile_name)
+        finally:
+            os.remove(profile_path)
+
+        backed_up = dict((name, current[name]) for name in include if current[name] is not None)
+        state_dir = os.path.dirname(os.path.abspath(state_path))
+        os.makedirs(state_dir, exist_ok=True)
+        with open(state_path + ".lock", "w") as lock:
+            # Other jobs may have recorded their destinations meanwhile
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = {}
+            if os.path.exists(state_path):
+                with open(state_path) as fobj:
+                    state = json.load(fobj)
+            state.setdefault(key, {}).update(backed_up)
+            # Written aside and renamed, so an interrupted write never leaves a broken state
+            fd, tmp_path = tempfile.mkstemp(dir=state_dir)
+            try:
+                with os.fdopen(fd, "w") as fobj:
+                    json.dump(state, fobj)
+                os.replace(tmp_path, state_path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        return VIRT_SUCCESS, {"changed": True, "backed_up": include, "skipped": skipped}
+
+    def service_call(self, vm, service, data=b"", user=None, timeout=None):
+        "Calls the qrexec service of the running VM with data as stdin, returns the exit code, stdout and stderr"
+        p = vm.run_service(service, user=user, autostart=False, stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = p.communicate(data, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            raise
+        return p.returncode, stdout, stderr
+
+    def root_shell(self, vm, cmd, data=b""):
+        "Runs the shell command as root in the VM, the rest of data is the stdin of the command"
+        payload = cmd.encode("utf-8") + b"\n" + data
+        retcode, stdout, stderr = self.service_call(vm, "qubes.VMRootShell", payload)
+        # Older VMs do not have qubes.VMRootShell
+        if retcode == 127:
+            retcode, stdout, stderr = self.service_call(vm, "qubes.VMShell", payload, user="root")
+        return retcode, stdout, stderr
+
+    def push(self, filters, src, dest, workers=4):
+        """ Copies the local file to dest in all the selected VMs, skipping the VMs which already have it """
+        # Read and hashed only once for all the VMs
+        with open(src, "rb") as fobj:
+            data = fobj.read()
+        digest = hashlib.sha256(data).hexdigest()
+        check_cmd = "sha256sum < {0}".format(shlex.quote(dest))
+        # An existing dest keeps its owner and mode, set on the empty temporary file before the data
+        # goes in. The temporary file is removed when anything fails.
+        write_cmd = ("if [ -e {1} ]; then (umask 077 && : > {0}) && chown --reference={1} {0} && "
+                     "chmod --reference={1} {0}; fi && cat > {0} && mv -f {0} {1} || "
+                     "{{ rm -f {0}; exit 1; }}").format(shlex.quote(dest + ".tmp"), shlex.quote(dest))
+
+        def push_vm(vmname):
+            vm = self.get_vm(vmname)
+            retcode, stdout, dummy = self.root_shell(vm, check_cmd)
+            if retcode == 0 and to_native(stdout).split()[0] == digest:
+                return {"changed": False}
+            retcode, dummy, stderr = self.root_shell(vm, write_cmd, data)
+            if retcode != 0:
+                return {"failed": True, "msg": to_native(stderr)}
+            return {"changed": True}
+
+        # The halted VMs can not receive the file
+        names = [vm.name for vm in self.select_vms(dict(filters, state="running"))]
+        return run_parallel(push_vm, names, workers)
+
+    def run(self, filters, cmd, workers=4, timeout=None):
+        """ Runs the shell command in all the selected VMs, returns the rc, stdout and stderr of each """
+        payload = cmd.encode("utf-8") + b"\n"
+
+        def run_vm(vmname):
+            try:
+                retcode, stdout, stderr = self.service_call(self.get_vm(vmname), "qubes.VMShell",
+                                                            payload, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                return {"failed": True, "msg": "Timed out after %s seconds" % timeout}
+            return {"rc": retcode, "stdout": to_native(stdout), "stderr": to_native(stderr)}
+
+        # The halted VMs are not started for the command
+        names = [vm.name for vm in self.select_vms(dict(filters, state="running"))]
+        return run_parallel(run_vm, names, workers)
+
+    def vm_field(self, vm, field):
+        "Returns the value of one of the INFO_FIELDS of the VM"
+        if field == "state":
+            return self.__get_state(vm)
+        if field == "tags":
+            return sorted(vm.tags)
+        value = getattr(vm, field, None)
+        # Labels and VMs are returned by their names
+        return getattr(value, "name", value)
+
+    def info(self, filters=None, fields=None):
+        info = dict()
+        fields = fields or ["state", "provides_network", "label"]
+        for vm in self.select_vms(filters or {}):
+            info[vm.name] = dict((field, self.vm_field(vm, field)) for field in fields)
 
         return info
 
@@ -265,7 +672,7 @@ class QubesVirt(object):
         vm.unpause()
         return 0
 
-    def create(self, vmname, vmtype="AppVM", label="red", template=None, netvm="default"):
+    def create(self, vmname, vmtype="AppVM", label="red", template=None, netvm="default", pool=None):
         """ Start the machine via the given vmid """
         network_vm = None
         template_vm = ""
@@ -278,13 +685,44 @@ class QubesVirt(object):
         else:
             network_vm = self.get_vm(netvm)
         if vmtype == "AppVM":
-            vm = self.app.add_new_vm(vmtype, vmname, label, template=template_vm)
+            vm = self.app.add_new_vm(vmtype, vmname, label, template=template_vm, pool=pool)
             vm.netvm = network_vm
         elif vmtype in ["StandaloneVM", "TemplateVM"] and template_vm:
-            vm = self.app.clone_vm(template_vm, vmname, vmtype)
+            # The volumes are cloned by the storage pool, which is a cheap
+            # snapshot/reflink on lvm_thin and file-reflink pools
+            vm = self.app.clone_vm(template_vm, vmname, vmtype, pool=pool)
             vm.label = label
+            vm.netvm = network_vm
         return 0
 
+    def provision(self, specs, pool=None, workers=4):
+        "Creates the given list of VMs concurrently, the VMs already present are left as is"
+        by_name = dict((spec["name"], spec) for spec in specs)
+
+        def provision_vm(vmname):
+            # Creating a VM clears the domains cache of the app, so every
+            # worker gets its own connection instead of sharing ours
+            worker = QubesVirt(self.module)
+            spec = by_name[vmname]
+            vmtype = spec.get("vmtype", "AppVM")
+            label = spec.get("label", "red")
+            template = spec.get("template")
+            result = {"changed": False}
+            try:
+                worker.get_vm(vmname)
+            except KeyError:
+                worker.create(vmname, vmtype, label, template, spec.get("netvm", "default"), pool=pool)
+                result.update({"changed": True, "created": True})
+            if spec.get("properties"):
+                changed, changed_values = worker.properties(vmname, spec["properties"], vmtype, label, template)
+                if isinstance(changed_values, dict):
+                    return {"failed": True, "msg": changed_values}
+                result["Properties updated"] = changed_values
+                result["changed"] = result["changed"] or changed
+            return result
+
+        return run_parallel(provision_vm, list(by_name), workers)
+
     def start(self, vmname):
         """ Start the machine via the given id/name """
 
@@ -398,19 +836,47 @@ class QubesVirt(object):
             if did_feature_changed:
                 values_changed.append("features")
         if "volume" in prefs:
-            val = prefs["volume"]
-            # Let us get the volume
-            try:
-                volume = vm.volumes[val["name"]]
-                volume.resize(val["size"])
-            except Exception:
-                return VIRT_FAILED, {"Failure in updating volume": val}
+            did_volume_changed = False
+            for val in prefs["volume"]:
+                # Let us get the volume
+                try:
+                    volume = vm.volumes[val["name"]]
+                    size = int(val["size"])
+                    if volume.size == size:
+                        continue
+                    if size < volume.size:
+                        return VIRT_FAILED, {"Volume can not be shrunk": val}
+                    volume.resize(size)
+                except Exception:
+                    return VIRT_FAILED, {"Failure in updating volume": val}
+                changed = True
+                did_volume_changed = True
+            if did_volume_changed:
+                values_changed.append("volume")
+        if "firewall" in prefs and self.set_firewall(vm, prefs["firewall"]):
             changed = True
-            values_changed.append("volume")
+            values_changed.append("firewall")
 
         return changed, values_changed
 
 
+    def set_firewall(self, vm, rules):
+        "Replaces the firewall rules of the VM if they differ, returns True if they did"
+        rules = [firewall_rule(rule) for rule in rules]
+        # One admin.vm.firewall.Get to read, and one Set for the whole list
+        if vm.firewall.rules == rules:
+            return False
+        vm.firewall.rules = rules
+        return True
+
+    def firewall(self, filters, rules, workers=4):
+        "Sets the firewall rules of all the selected VMs"
+        def firewall_vm(vmname):
+            return {"changed": self.set_firewall(self.get_vm(vmname), rules)}
+
+        names = [vm.name for vm in self.select_vms(filters)]
+        return run_parallel(firewall_vm, names, workers)
+
     def undefine(self, vmname):
         """ Stop a domain, and then wipe it from the face of the earth.  (delete disk/config file) """
         try:
@@ -419,13 +885,181 @@ class QubesVirt(object):
             pass
             # Because it is not running
 
-        while True:
-            if self.__get_state(vmname) == "shutdown":
-                break
-            time.sleep(1)
+        self.wait_for_shutdown(vmname)
         del self.app.domains[vmname]
         return 0
 
+    def import_volume(self, vmname, volname, path):
+        """ Streams the content of the local file at path into the given volume of the halted VM """
+        if self.__get_state(vmname) != "shutdown":
+            return VIRT_FAILED, {"VM must be shutdown to import a volume": vmname}
+        volume = self.get_vm(vmname).volumes[volname]
+        size = os.path.getsize(path)
+        with open(path, "rb") as fobj:
+            # The file object is passed as the stdin of the qubesd call, so
+            # the data never has to be read into memory here
+            if hasattr(volume, "import_data_with_size"):
+                volume.import_data_with_size(fobj, size)
+            else:
+                volume.import_data(fobj)
+        return VIRT_SUCCESS, {"changed": True, "imported": size}
+
+    def volume_path(self, volume):
+        "Returns the dom0 path of the data of the given volume, None for unsupported pools"
+        pool = self.app.pools[volume.pool]
+        if pool.driver == "lvm_thin":
+            return os.path.join("/dev", volume.vid)
+        if pool.driver in ["file", "file-reflink"]:
+            return os.path.join(pool.config["dir_path"], volume.vid + ".img")
+        return None
+
+    def export_volume(self, vmname, volname, path):
+        """ Copies the given volume of the VM into the local file at path, keeping it sparse """
+        volume = self.get_vm(vmname).volumes[volname]
+        # The Admin API has no export call, the data is read from the pool directly
+        source = self.volume_path(volume)
+        if not source:
+            return VIRT_FAILED, {"Export is not supported for the pool": volume.pool}
+        with open(source, "rb") as src, open(path, "wb") as dst:
+            size = copy_sparse(src, dst)
+        return VIRT_SUCCESS, {"changed": True, "exported": size}
+
+    def wait_for_shutdown(self, vmname, interval=0.2, timeout=None):
+        "Waits till the given VM is halted, at most timeout seconds if given"
+        start = time.time()
+        while self.__get_state(vmname) != "shutdown":
+            if timeout is not None and time.time() - start > timeout:
+                raise RuntimeError("%s did not shutdown in %s seconds" % (vmname, timeout))
+            time.sleep(interval)
+
+    def migrate_template(self, filters, new_template, workers=4, timeout=60):
+        """ Moves the selected VMs to the new template, restarting the ones which were running """
+        if new_template == "default":
+            template = self.app.default_template
+        else:
+            template = self.get_vm(new_template)
+        vms = self.select_vms(filters)
+        states = dict((vm.name, self.__get_state(vm)) for vm in vms)
+        # A paused VM can not shutdown cleanly, leave it to the user
+        results = dict((name, {"failed": True, "msg": "VM is paused"})
+                       for name, state in states.items() if state == "paused")
+        vms = [vm for vm in vms if vm.name not in results]
+        running = [vm.name for vm in vms if states[vm.name] == "running"]
+
+        # A netvm can only shutdown after its clients, and must start before
+        # them, so the VMs are handled in batches by their depth in the netvm
+        # chains of the selected VMs
+        netvms = dict((vm.name, getattr(getattr(vm, "netvm", None), "name", None)) for vm in vms)
+        batches = {}
+        for name in netvms:
+            depth = 0
+            provider = netvms[name]
+            while provider in netvms:
+                depth += 1
+                provider = netvms[provider]
+            batches.setdefault(depth, []).append(name)
+
+        def switch_vm(vmname):
+            start = time.time()
+            if vmname in running:
+                self.shutdown(vmname)
+                self.wait_for_shutdown(vmname, timeout=timeout)
+            shutdown_time = time.time() - start
+            self.get_vm(vmname).template = template
+            return {"changed": True, "shutdown": round(shutdown_time, 3),
+                    "switch": round(time.time() - start - shutdown_time, 3)}
+
+        def start_vm(vmname):
+            start = time.time()
+            try:
+                self.start(vmname)
+            except Exception as e:
+                # Kept apart from the msg of a failed switch
+                return {"failed": True, "start_error": to_native(e)}
+            return {"start": round(time.time() - start, 3)}
+
+        for depth in sorted(batches, reverse=True):
+            results.update(run_parallel(switch_vm, batches[depth], workers))
+        for depth in sorted(batches):
+            # Even if the switch failed, a VM which was running must not
+            # be left stopped
+            names = [name for name in batches[depth]
+                     if name in running and self.__get_state(name) == "shutdown"]
+            for name, result in run_parallel(start_vm, names, workers).items():
+                results[name].update(result)
+        return results
+
+    def reset(self, vmname, volumes=None, revision=None):
+        """ Reverts the volumes of the VM to an earlier revision, killing the VM first if it is running """
+        vm = self.get_vm(vmname)
+        if revision and not volumes:
+            # Revisions are per volume, one can not fit all the volumes
+            return VIRT_FAILED, {"Error": "revision requires the volumes to revert"}
+        if not volumes:
+            # Only the volumes which are kept across restarts have revisions
+            volumes = [name for name, volume in vm.volumes.items() if volume.save_on_stop]
+        for name in volumes:
+            if name not in vm.volumes:
+                return VIRT_FAILED, {"Missing volume": name}
+
+        if self.__get_state(vmname) != "shutdown":
+            self.destroy_and_wait(vmname)
+
+        # Stopping the VM commits its volumes, which adds a revision, so
+        # the revisions are only read once the storage is stopped
+        revisions = {}
+        for name in volumes:
+            available = vm.volumes[name].revisions
+            if not available:
+                return VIRT_FAILED, {"Missing revisions for the volume": name}
+            if revision and revision not in available:
+                return VIRT_FAILED, {"Missing revision": revision, "available": available}
+            revisions[name] = revision or available[-1]
+        for name, rev in revisions.items():
+            self.revert_volume(vm.volumes[name], rev)
+        return VIRT_SUCCESS, {"changed": True, "reverted": revisions}
+
+    def destroy_and_wait(self, vmname, timeout=60):
+        "Kills the VM and waits till qubesd has stopped its storage too"
+        async def kill():
+            connected = asyncio.Event()
+            stopped = asyncio.Event()
+            dispatcher = EventsDispatcher(self.app)
+            dispatcher.add_handler('connection-established', lambda subject, event, **kwargs: connected.set())
+
+            # domain-shutdown comes after the storage is stopped,
+            # is_halted() is true already before that
+            def handler(subject, event, **kwargs):
+                if subject is not None and subject.name == vmname:
+                    stopped.set()
+
+            dispatcher.add_handler('domain-shutdown', handler)
+            listener = asyncio.ensure_future(dispatcher.listen_for_events(reconnect=False))
+            try:
+                await asyncio.wait_for(connected.wait(), timeout)
+                try:
+                    self.destroy(vmname)
+                except QubesVMNotStartedError:
+                    # Halted meanwhile, nothing more to wait for
+                    return
+                await asyncio.wait_for(stopped.wait(), timeout)
+            finally:
+                listener.cancel()
+
+        asyncio.run(kill())
+
+    def revert_volume(self, volume, revision, timeout=60):
+        "Reverts the volume, retrying while qubesd still has it in use"
+        start = time.time()
+        while True:
+            try:
+                volume.revert(revision)
+                return
+            except QubesException:
+                if time.time() - start > timeout:
+                    raise
+                time.sleep(0.2)
+
     def status(self, vmname):
         """
         Return a state suitable for server consumption.  Aka, codes.py values, not XM output.
@@ -440,6 +1074,74 @@ class QubesVirt(object):
         return 0
 
 
+def check_properties(v, properties, vmtype):
+    "Validates the given properties, returns the failure (if any) or None"
+    for key,val in properties.items():
+        if not key in PROPS:
+            return VIRT_FAILED, {"Invalid property": key}
+        # A single volume can be given without the list
+        if key == "volume" and isinstance(val, dict):
+            val = properties[key] = [val]
+        if type(val) != PROPS[key]:
+            return VIRT_FAILED, {"Invalid property value type": key}
+        # Make sure that the netvm exists
+        if key == "netvm" and val != "":
+            try:
+                vm = v.get_vm(val)
+            except KeyError:
+                return VIRT_FAILED, {"Missing netvm": val}
+            # Also the vm should provide network
+            if not vm.provides_network:
+                return VIRT_FAILED, {"Missing netvm capability": val}
+
+        # Make sure every volume has both name and value
+        if key == "volume":
+            allowed_name = []
+            if vmtype == 'AppVM':
+                allowed_name.append("private")
+            elif vmtype in ["StandaloneVM", "TemplateVM"]:
+                allowed_name.extend(["root", "private"])
+
+            for item in val:
+                if not isinstance(item, dict):
+                    return VIRT_FAILED, {"Wrong volume": item}
+                if "name" not in item:
+                    return VIRT_FAILED, {"Missing name for the volume": item}
+                elif "size" not in item:
+                    return VIRT_FAILED, {"Missing size for the volume": item}
+                try:
+                    int(item["size"])
+                except (ValueError, TypeError):
+                    return VIRT_FAILED, {"Wrong size for the volume": item}
+
+                if not item["name"] in allowed_name:
+                    return VIRT_FAILED, {"Wrong volume name": item}
+
+        # Make sure that every firewall rule is valid
+        if key == "firewall":
+            for rule in val:
+                # A mistyped key would make the rule broader than intended
+                if isinstance(rule, dict):
+                    for field in rule:
+                        if not field in FIREWALL_RULE_FIELDS:
+                            return VIRT_FAILED, {"Invalid firewall rule field": field}
+                try:
+                    firewall_rule(rule)
+                except (ValueError, TypeError):
+                    return VIRT_FAILED, {"Invalid firewall rule": rule}
+
+        # Make sure that the default_dispvm exists
+        if key == "default_dispvm":
+            try:
+                vm = v.get_vm(val)
+            except KeyError:
+                return VIRT_FAILED, {"Missing default_dispvm": val}
+            # Also the vm should provide network
+            if not vm.template_for_dispvms:
+                return VIRT_FAILED, {"Missing dispvm capability": val}
+    return None
+
+
 def core(module):
 
     state = module.params.get('state', None)
@@ -450,54 +1152,52 @@ def core(module):
     template = module.params.get('template', None)
     properties = module.params.get('properties', {})
     tags = module.params.get('tags', [])
+    vms = module.params.get('vms', [])
+    workers = module.params.get('workers', 4)
+    pool = module.params.get('pool', None)
+    volumes = module.params.get('volumes', [])
+    revision = module.params.get('revision', None)
+    volume = module.params.get('volume', None)
+    path = module.params.get('path', None)
+    filters = module.params.get('filters', {})
+    until = module.params.get('until', None)
+    timeout = module.params.get('timeout', 60)
+    destination_vm = module.params.get('destination_vm', 'dom0')
+    passphrase = module.params.get('passphrase', None)
+    compression = module.params.get('compression', 'pigz')
+    backup_state = module.params.get('backup_state')
+    incremental = module.params.get('incremental', True)
+    src = module.params.get('src', None)
+    dest = module.params.get('dest', None)
+    cmd = module.params.get('cmd', None)
+    fields = module.params.get('fields', [])
+    new_template = module.params.get('new_template', None)
 
     v = QubesVirt(module)
     res = dict()
 
+    for key, val in filters.items():
+        if not key in FILTERS:
+            return VIRT_FAILED, {"Invalid filter": key}
+        if type(val) != FILTERS[key]:
+            return VIRT_FAILED, {"Invalid filter value type": key}
+    # A mistyped name would be silently left out of the selection
+    for name in filters.get("names", []):
+        try:
+            v.get_vm(name)
+        except KeyError:
+            return VIRT_FAILED, {"Missing vm": name}
+
     # properties will only work with state=present
     if properties:
-        for key,val in properties.items():
-            if not key in PROPS:
-                return VIRT_FAILED, {"Invalid property": key}
-            if type(val) != PROPS[key]:
-                return VIRT_FAILED, {"Invalid property value type": key}
-            # Make sure that the netvm exists
-            if key == "netvm" and val != "":
-                try:
-                    vm = v.get_vm(val)
-                except KeyError:
-                    return VIRT_FAILED, {"Missing netvm": val}
-                # Also the vm should provide network
-                if not vm.provides_network:
-                    return VIRT_FAILED, {"Missing netvm capability": val}
-
-            # Make sure volume has both name and value
-            if key == "volume":
-                if "name" not in val:
-                    return VIRT_FAILED, {"Missing name for the volume": val}
-                elif "size" not in val:
-                    return VIRT_FAILED, {"Missing size for the volume": val}
-
-                allowed_name = []
-                if vmtype == 'AppVM':
-                    allowed_name.append("private")
-                elif vmtype in ["StandAloneVM", "TemplateVM"]:
-                    allowed_name.append("root")
-
-                if not val["name"] in allowed_name:
-                    return VIRT_FAILED, {"Wrong volume name": val}
-
-            # Make sure that the default_dispvm exists
-            if key == "default_dispvm":
-                try:
-                    vm = v.get_vm(val)
-                except KeyError:
-                    return VIRT_FAILED, {"Missing default_dispvm": val}
-                # Also the vm should provide network
-                if not vm.template_for_dispvms:
-                    return VIRT_FAILED, {"Missing dispvm capability": val}
+        failure = check_properties(v, properties, vmtype)
+        if failure:
+            return failure
         if state == "present" and guest and vmtype:
             changed, changed_values = v.properties(guest, properties, vmtype, label, template)
+            # A failed update comes back as the failure details
+            if isinstance(changed_values, dict):
+                return VIRT_FAILED, changed_values
             if tags:
                 # Apply the tags
                 v.tags(guest, tags)
@@ -516,17 +1216,99 @@ def core(module):
             res = {'changed': True, 'created': guest}
         return VIRT_SUCCESS, res
 
-    if state and command == 'list_vms':
-        res = v.list_vms(state=state)
+    if command == 'list_vms':
+        res = v.list_vms(state=state, filters=filters)
         if not isinstance(res, dict):
             res = {command: res}
         return VIRT_SUCCESS, res
 
+    if command == 'info':
+        for field in fields:
+            if not field in INFO_FIELDS:
+                return VIRT_FAILED, {"Invalid field": field}
+        # Like before, the VM names are the keys of the result
+        return VIRT_SUCCESS, v.info(filters, fields)
+
     if command == "get_states":
         states = v.get_states()
         res = {"states": states}
         return VIRT_SUCCESS, res
 
+    if command == "provision":
+        if not vms:
+            return VIRT_FAILED, {"Error": "Missing vms to provision."}
+        seen = set()
+        for spec in vms:
+            if not isinstance(spec, dict) or "name" not in spec:
+                return VIRT_FAILED, {"Missing name for the vm": spec}
+            if spec["name"] in seen:
+                return VIRT_FAILED, {"Duplicate vm": spec["name"]}
+            # Those are cloned, there is nothing to create them from otherwise
+            if spec.get("vmtype", "AppVM") in ["StandaloneVM", "TemplateVM"] and not spec.get("template"):
+                return VIRT_FAILED, {"Missing template for the vm": spec["name"]}
+            seen.add(spec["name"])
+            if spec.get("properties"):
+                failure = check_properties(v, spec["properties"], spec.get("vmtype", "AppVM"))
+                if failure:
+                    return failure
+        results = v.provision(vms, pool, workers)
+        failed = sorted(name for name, result in results.items() if result.get("failed"))
+        if failed:
+            return VIRT_FAILED, {"Failed to provision": failed, "provisioned": results}
+        changed = any(result["changed"] for result in results.values())
+        return VIRT_SUCCESS, {"changed": changed, "provisioned": results}
+
+    if command == "watch":
+        return v.watch(filters, until, timeout)
+
+    if command == "backup":
+        if not path or not passphrase:
+            return VIRT_FAILED, {"Error": "backup requires path and passphrase"}
+        return v.backup(filters, destination_vm, path, passphrase, compression,
+                        os.path.expanduser(backup_state), incremental)
+
+    if command == "push":
+        if not src or not dest:
+            return VIRT_FAILED, {"Error": "push requires src and dest"}
+        if filters.get("state", "running") != "running":
+            return VIRT_FAILED, {"Error": "push only works on running vms"}
+        results = v.push(filters, src, dest, workers)
+        failed = sorted(name for name, result in results.items() if result.get("failed"))
+        if failed:
+            return VIRT_FAILED, {"Failed to push": failed, "pushed": results}
+        changed = any(result["changed"] for result in results.values())
+        return VIRT_SUCCESS, {"changed": changed, "pushed": results}
+
+    if command == "run":
+        if not cmd:
+            return VIRT_FAILED, {"Error": "run requires cmd"}
+        if filters.get("state", "running") != "running":
+            return VIRT_FAILED, {"Error": "run only works on running vms"}
+        results = v.run(filters, cmd, workers, timeout)
+        failed = sorted(name for name, result in results.items() if result.get("failed"))
+        if failed:
+            return VIRT_FAILED, {"Failed to run": failed, "results": results}
+        return VIRT_SUCCESS, {"changed": True, "results": results}
+
+    if command == "firewall":
+        if "firewall" not in properties or not filters:
+            return VIRT_FAILED, {"Error": "firewall requires filters and the firewall property"}
+        results = v.firewall(filters, properties["firewall"], workers)
+        failed = sorted(name for name, result in results.items() if result.get("failed"))
+        if failed:
+            return VIRT_FAILED, {"Failed to set firewall": failed, "results": results}
+        changed = any(result["changed"] for result in results.values())
+        return VIRT_SUCCESS, {"changed": changed, "results": results}
+
+    if command == "migrate_template":
+        if not filters.get("template") or not new_template:
+            return VIRT_FAILED, {"Error": "migrate_template requires new_template and the old template in filters"}
+        results = v.migrate_template(filters, new_template, workers, timeout)
+        failed = sorted(name for name, result in results.items() if result.get("failed"))
+        if failed:
+            return VIRT_FAILED, {"Failed to migrate": failed, "migrated": results}
+        return VIRT_SUCCESS, {"changed": bool(results), "migrated": results}
+
     if command == "createinventory":
         result = v.all_vms()
         create_inventory(result)
@@ -557,6 +1339,10 @@ def core(module):
                     except QubesTagNotFoundError:
                         pass
                 return VIRT_SUCCESS, {"Message": "Removed the tag(s).", "changed": changed}
+            elif command in ['import_volume', 'export_volume']:
+                if not volume or not path:
+                    return VIRT_FAILED, {"Error": "%s requires volume and path" % command}
+                return getattr(v, command)(guest, volume, path)
             res = getattr(v, command)(guest)
             if not isinstance(res, dict):
                 res = {command: res}
@@ -598,6 +1384,8 @@ def core(module):
             if v.status(guest) is not 'shutdown':
                 res['changed'] = True
                 res['msg'] = v.undefine(guest)
+        elif state == 'reset':
+            return v.reset(guest, volumes, revision)
         else:
             module.fail_json(msg="unexpected state")
 
@@ -611,13 +1399,33 @@ def main():
     module = AnsibleModule(
         argument_spec=dict(
             name=dict(type='str', aliases=['guest']),
-            state=dict(type='str', choices=['destroyed', 'pause', 'running', 'shutdown', 'undefine', 'present']),
+            state=dict(type='str', choices=['destroyed', 'pause', 'running', 'shutdown', 'undefine', 'present', 'reset']),
             command=dict(type='str', choices=ALL_COMMANDS),
             label=dict(type='str', default='red'),
             vmtype=dict(type='str', default='AppVM'),
             template=dict(type='str', default='default'),
             properties=dict(type='dict', default={}),
             tags=dict(type='list', default=[]),
+            vms=dict(type='list', default=[]),
+            workers=dict(type='int', default=4),
+            pool=dict(type='str', default=None),
+            volumes=dict(type='list', default=[]),
+            revision=dict(type='str', default=None),
+            volume=dict(type='str', default=None),
+            path=dict(type='str', default=None),
+            filters=dict(type='dict', default={}),
+            until=dict(type='str', choices=['running', 'paused', 'shutdown']),
+            timeout=dict(type='int', default=60),
+            destination_vm=dict(type='str', default='dom0'),
+            passphrase=dict(type='str', no_log=True),
+            compression=dict(type='str', default='pigz'),
+            backup_state=dict(type='str', default='~/.qubes-ansible/backup-state.json'),
+            incremental=dict(type='bool', default=True),
+            src=dict(type='path'),
+            dest=dict(type='str'),
+            cmd=dict(type='str'),
+            fields=dict(type='list', default=[]),
+            new_template=dict(type='str'),
         ),
     )
 